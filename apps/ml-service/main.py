@@ -4,19 +4,27 @@ FastAPI service for cash flow prediction using Prophet
 """
 
 import os
+import asyncio
+import hashlib
+import io
+import json
 import logging
 from datetime import datetime, timedelta
+from statistics import NormalDist
 from typing import Optional
 from contextlib import asynccontextmanager
 
 import numpy as np
 import pandas as pd
+from cachetools import TTLCache
 from fastapi import FastAPI, HTTPException, BackgroundTasks
 from pydantic import BaseModel, Field
 from pydantic_settings import BaseSettings
 from prophet import Prophet
+from prophet.serialize import model_from_json, model_to_json
 from sklearn.ensemble import IsolationForest
 import redis.asyncio as redis
+from redis.exceptions import RedisError
 from sqlalchemy import create_engine, text
 from sqlalchemy.orm import sessionmaker
 import httpx
@@ -31,6 +39,14 @@ class Settings(BaseSettings):
     redis_url: str = "redis://localhost:6379"
     api_url: str = "http://localhost:3001"
     model_version: str = "1.0.0"
+    forecast_cache_ttl: int = 86400  # seconds
+    # Fit a separate model per scenario instead of rescaling the baseline fit
+    refit_scenarios: bool = False
+    anomaly_model_ttl: int = 900  # seconds
+    # History fed to Prophet; three yearly cycles covers yearly seasonality
+    training_window_days: int = 1095
+    # Construct a Prophet model at startup to import and check the Stan backend
+    prophet_warmup: bool = True
 
     class Config:
         env_file = ".env"
@@ -39,18 +55,31 @@ class Settings(BaseSettings):
 settings = Settings()
 
 # Database setup
-engine = create_engine(settings.database_url)
+# values_plus_batch lets psycopg2 page executemany() calls into batched
+# round-trips instead of issuing one statement per parameter set
+engine = create_engine(
+    settings.database_url,
+    executemany_mode="values_plus_batch",
+    pool_size=10,
+    max_overflow=20,
+    pool_pre_ping=True,  # Drop stale connections before background tasks use them
+)
 SessionLocal = sessionmaker(bind=engine)
 
 # Redis client
 redis_client: Optional[redis.Redis] = None
 
+# Fitted anomaly models per company: (training row count, model)
+anomaly_models: TTLCache = TTLCache(maxsize=256, ttl=settings.anomaly_model_ttl)
+
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Startup and shutdown events"""
     global redis_client
     redis_client = redis.from_url(settings.redis_url)
+    if settings.prophet_warmup:
+        await asyncio.to_thread(warm_up_prophet)
     logger.info("ML Service started")
     yield
     if redis_client:
@@ -58,6 +87,37 @@ async def lifespan(app: FastAPI):
     logger.info("ML Service stopped")
 
 
+def warm_up_prophet():
+    """Import cmdstanpy and check the Stan binary before serving requests"""
+    # Each Prophet instance still loads its own CmdStanModel; constructing
+    # one here only pays the one-off import and surfaces a broken install
+    try:
+        Prophet(stan_backend="CMDSTANPY")
+    except Exception as e:
+        logger.warning(f"Prophet warm-up failed: {e}")
+
+
+async def cache_get(key: str) -> Optional[bytes]:
+    """Read a cached blob, treating Redis errors as a cache miss"""
+    if redis_client is None:
+        return None
+    try:
+        return await redis_client.get(key)
+    except RedisError as e:
+        logger.warning(f"Cache read failed for {key}: {e}")
+        return None
+
+
+async def cache_set(key: str, value: bytes, ttl: int):
+    """Write a cached blob, ignoring Redis errors"""
+    if redis_client is None:
+        return
+    try:
+        await redis_client.setex(key, ttl, value)
+    except RedisError as e:
+        logger.warning(f"Cache write failed for {key}: {e}")
+
+
 app = FastAPI(
     title="CashFlow AI ML Service",
     description="Machine learning service for cash flow forecasting",
@@ -138,166 +198,314 @@ async def run_forecast_pipeline(
     horizon_days: int,
 ):
     """Execute the full forecast pipeline"""
+    # Blocking DB calls and model fitting run in worker threads so the event
+    # loop keeps serving other requests while a forecast is in progress
     start_time = datetime.utcnow()
 
     try:
         with SessionLocal() as session:
             # Update status to processing
-            session.execute(
-                text("""
-                    UPDATE forecast_runs
-                    SET status = 'processing'
-                    WHERE id = :run_id
-                """),
-                {"run_id": forecast_run_id},
-            )
-            session.commit()
+            await asyncio.to_thread(mark_run_processing, session, forecast_run_id)
 
             # Fetch transaction data
-            transactions = fetch_transactions(session, company_id)
+            transactions = await asyncio.to_thread(fetch_transactions, session, company_id)
 
             if len(transactions) < 90:
                 raise ValueError("Insufficient transaction history (need 90+ days)")
 
+            # Net flow before the training window, so the balance keeps its level
+            opening_balance = await asyncio.to_thread(
+                fetch_opening_balance, session, company_id
+            )
+
             # Prepare data for Prophet
-            df = prepare_prophet_data(transactions)
+            df = prepare_prophet_data(transactions, opening_balance)
 
             # Generate forecasts for each scenario
-            scenarios = ["pessimistic", "baseline", "optimistic"]
-            accuracy_metrics = {}
-
-            for scenario in scenarios:
-                forecasts = generate_prophet_forecast(
-                    df, horizon_days, scenario
-                )
-
-                # Store forecasts
-                store_forecasts(
-                    session,
-                    forecast_run_id,
-                    company_id,
-                    forecasts,
-                    scenario,
-                )
-
-                # Calculate accuracy metrics for baseline
-                if scenario == "baseline":
-                    accuracy_metrics = calculate_accuracy(df, forecasts)
+            scenario_forecasts = await generate_scenario_forecasts(
+                df, horizon_days, company_id
+            )
+
+            # Store all scenarios in a single transaction
+            await asyncio.to_thread(
+                store_scenario_forecasts,
+                session,
+                forecast_run_id,
+                company_id,
+                scenario_forecasts,
+            )
+
+            # Calculate accuracy metrics for baseline
+            accuracy_metrics = await get_accuracy_metrics(
+                df, scenario_forecasts["baseline"], company_id
+            )
 
             # Update run as completed
             processing_time = int((datetime.utcnow() - start_time).total_seconds() * 1000)
 
-            session.execute(
-                text("""
-                    UPDATE forecast_runs
-                    SET status = 'completed',
-                        completed_at = NOW(),
-                        processing_time_ms = :time_ms,
-                        accuracy_metrics = :metrics::jsonb
-                    WHERE id = :run_id
-                """),
-                {
-                    "run_id": forecast_run_id,
-                    "time_ms": processing_time,
-                    "metrics": str(accuracy_metrics).replace("'", '"'),
-                },
+            await asyncio.to_thread(
+                mark_run_completed,
+                session,
+                forecast_run_id,
+                processing_time,
+                accuracy_metrics,
             )
-            session.commit()
 
             logger.info(f"Forecast completed for run {forecast_run_id} in {processing_time}ms")
 
             # Generate alerts from forecast
-            await generate_forecast_alerts(session, company_id, forecast_run_id)
+            await asyncio.to_thread(
+                generate_forecast_alerts, session, company_id, forecast_run_id
+            )
 
     except Exception as e:
         logger.error(f"Forecast failed: {e}")
-        with SessionLocal() as session:
-            session.execute(
-                text("""
-                    UPDATE forecast_runs
-                    SET status = 'failed',
-                        error_message = :error
-                    WHERE id = :run_id
-                """),
-                {"run_id": forecast_run_id, "error": str(e)},
-            )
-            session.commit()
+        await asyncio.to_thread(mark_run_failed, forecast_run_id, str(e))
+
+
+def mark_run_processing(session, forecast_run_id: str):
+    """Mark a forecast run as processing"""
+    session.execute(
+        text("""
+            UPDATE forecast_runs
+            SET status = 'processing'
+            WHERE id = :run_id
+        """),
+        {"run_id": forecast_run_id},
+    )
+    session.commit()
+
+
+def mark_run_completed(
+    session,
+    forecast_run_id: str,
+    processing_time: int,
+    accuracy_metrics: dict,
+):
+    """Mark a forecast run as completed and record its metrics"""
+    session.execute(
+        text("""
+            UPDATE forecast_runs
+            SET status = 'completed',
+                completed_at = NOW(),
+                processing_time_ms = :time_ms,
+                accuracy_metrics = CAST(:metrics AS jsonb)
+            WHERE id = :run_id
+        """),
+        {
+            "run_id": forecast_run_id,
+            "time_ms": processing_time,
+            "metrics": json.dumps(accuracy_metrics, allow_nan=False),
+        },
+    )
+    session.commit()
+
+
+def mark_run_failed(forecast_run_id: str, error: str):
+    """Mark a forecast run as failed in a fresh session"""
+    with SessionLocal() as session:
+        session.execute(
+            text("""
+                UPDATE forecast_runs
+                SET status = 'failed',
+                    error_message = :error
+                WHERE id = :run_id
+            """),
+            {"run_id": forecast_run_id, "error": error},
+        )
+        session.commit()
 
 
 def fetch_transactions(session, company_id: str) -> pd.DataFrame:
-    """Fetch transaction history for a company"""
-    result = session.execute(
+    """Fetch daily transaction totals (in dollars) for a company"""
+    # Cents-to-dollars conversion happens in SQL so rows arrive as float8.
+    # Only the training window is read (earlier history is folded into
+    # fetch_opening_balance); with a covering index on
+    # transactions (company_id, transaction_date) INCLUDE (amount) this is an
+    # index-only scan (see scripts/init-timescale.sql).
+    return pd.read_sql_query(
         text("""
             SELECT
                 transaction_date::date as ds,
-                SUM(amount) as amount
+                SUM(amount)::float8 / 100.0 as amount
             FROM transactions
             WHERE company_id = :company_id
+            AND transaction_date >= NOW() - make_interval(days => :window_days)
             GROUP BY transaction_date::date
             ORDER BY ds
         """),
-        {"company_id": company_id},
+        session.connection(),
+        params={
+            "company_id": company_id,
+            "window_days": settings.training_window_days,
+        },
+        parse_dates=["ds"],
     )
 
-    rows = result.fetchall()
-    df = pd.DataFrame(rows, columns=["ds", "amount"])
-    df["amount"] = df["amount"].astype(float) / 100  # Convert cents to dollars
-    return df
+
+def fetch_opening_balance(session, company_id: str) -> float:
+    """Fetch the net transaction total (in dollars) before the training window"""
+    # Same cutoff as fetch_transactions; NOW() is fixed for the transaction,
+    # so the two queries split the history exactly
+    result = session.execute(
+        text("""
+            SELECT COALESCE(SUM(amount), 0)::float8 / 100.0
+            FROM transactions
+            WHERE company_id = :company_id
+            AND transaction_date < NOW() - make_interval(days => :window_days)
+        """),
+        {
+            "company_id": company_id,
+            "window_days": settings.training_window_days,
+        },
+    )
+    return result.scalar()
 
 
-def prepare_prophet_data(df: pd.DataFrame) -> pd.DataFrame:
+def prepare_prophet_data(df: pd.DataFrame, opening_balance: float = 0.0) -> pd.DataFrame:
     """Prepare data for Prophet model"""
-    # Prophet expects 'ds' and 'y' columns
-    df = df.copy()
-    df["ds"] = pd.to_datetime(df["ds"])
+    # Prophet expects 'ds' and 'y' columns; y is the cumulative balance
+    # (running sum from the opening balance), computed on the raw float64 array
+    return pd.DataFrame({
+        "ds": df["ds"],
+        "y": opening_balance + np.cumsum(df["amount"].to_numpy(dtype=np.float64)),
+    })
+
+
+# Scenario parameters
+SCENARIO_INTERVAL_WIDTH = {
+    "pessimistic": 0.95,  # Wide intervals
+    "baseline": 0.80,
+    "optimistic": 0.65,  # Narrow intervals
+}
+
+SCENARIO_CHANGEPOINT_SCALE = {
+    "pessimistic": 0.1,  # More conservative
+    "baseline": 0.05,
+    "optimistic": 0.02,  # More stable
+}
+
+
+async def generate_scenario_forecasts(
+    df: pd.DataFrame,
+    horizon_days: int,
+    company_id: str,
+) -> dict[str, pd.DataFrame]:
+    """Generate pessimistic, baseline and optimistic forecasts"""
+    if settings.refit_scenarios:
+        # Fits are independent, so run them concurrently. Prophet's cmdstanpy
+        # backend optimizes in a separate process, so the worker threads used
+        # by generate_prophet_forecast fit in parallel across cores.
+        scenarios = list(SCENARIO_INTERVAL_WIDTH)
+        forecasts = await asyncio.gather(*(
+            generate_prophet_forecast(df, horizon_days, scenario, company_id)
+            for scenario in scenarios
+        ))
+        return dict(zip(scenarios, forecasts))
+
+    # Fit once and derive the other scenarios from the baseline intervals
+    baseline = await generate_prophet_forecast(
+        df, horizon_days, "baseline", company_id
+    )
+    return {
+        scenario: rescale_intervals(baseline, width)
+        for scenario, width in SCENARIO_INTERVAL_WIDTH.items()
+    }
+
 
-    # Calculate cumulative balance (running sum)
-    df["y"] = df["amount"].cumsum()
+def rescale_intervals(forecast: pd.DataFrame, interval_width: float) -> pd.DataFrame:
+    """Rescale baseline prediction intervals to another interval width"""
+    baseline_width = SCENARIO_INTERVAL_WIDTH["baseline"]
+    if interval_width == baseline_width:
+        return forecast
 
-    return df[["ds", "y"]]
+    def z(width: float) -> float:
+        return NormalDist().inv_cdf(0.5 + width / 2)
 
+    ratio = z(interval_width) / z(baseline_width)
+    forecast = forecast.copy()
+    forecast["yhat_lower"] = forecast["yhat"] - (forecast["yhat"] - forecast["yhat_lower"]) * ratio
+    forecast["yhat_upper"] = forecast["yhat"] + (forecast["yhat_upper"] - forecast["yhat"]) * ratio
+    return forecast
 
-def generate_prophet_forecast(
+
+def prophet_data_hash(df: pd.DataFrame) -> str:
+    """Hash the Prophet training frame for use in cache keys"""
+    return hashlib.blake2b(
+        pd.util.hash_pandas_object(df, index=False).values.tobytes()
+    ).hexdigest()
+
+
+async def generate_prophet_forecast(
     df: pd.DataFrame,
     horizon_days: int,
     scenario: str,
+    company_id: str,
 ) -> pd.DataFrame:
-    """Generate forecast using Prophet"""
+    """Generate forecast using Prophet, reusing cached fits for unchanged data"""
+    # Cached values are JSON rather than pickles: Prophet models don't pickle
+    # reliably, and loading a pickle from Redis would execute arbitrary code
+    data_hash = prophet_data_hash(df)
+    model_key = f"v2:prophet:{company_id}:{scenario}:{data_hash}"
+    forecast_key = f"{model_key}:{horizon_days}"
+
+    cached_forecast = await cache_get(forecast_key)
+    if cached_forecast is not None:
+        return pd.read_json(
+            io.StringIO(cached_forecast.decode()),
+            orient="split",
+            convert_dates=["ds"],
+        )
 
     # Adjust parameters based on scenario
-    interval_width = {
-        "pessimistic": 0.95,  # Wide intervals
-        "baseline": 0.80,
-        "optimistic": 0.65,  # Narrow intervals
-    }[scenario]
-
-    changepoint_scale = {
-        "pessimistic": 0.1,  # More conservative
-        "baseline": 0.05,
-        "optimistic": 0.02,  # More stable
-    }[scenario]
-
-    # Initialize and fit Prophet model
-    model = Prophet(
-        interval_width=interval_width,
-        changepoint_prior_scale=changepoint_scale,
-        yearly_seasonality=True,
-        weekly_seasonality=True,
-        daily_seasonality=False,
-    )
+    interval_width = SCENARIO_INTERVAL_WIDTH[scenario]
+    changepoint_scale = SCENARIO_CHANGEPOINT_SCALE[scenario]
+
+    cached_model = await cache_get(model_key)
+    if cached_model is not None:
+        model = model_from_json(cached_model.decode())
+    else:
+        # Initialize and fit Prophet model
+        model = Prophet(
+            interval_width=interval_width,
+            changepoint_prior_scale=changepoint_scale,
+            yearly_seasonality=True,
+            weekly_seasonality=True,
+            daily_seasonality=False,
+            uncertainty_samples=200,  # Enough for the 80% confidence bounds
+            stan_backend="CMDSTANPY",
+        )
 
-    model.fit(df)
+        await asyncio.to_thread(model.fit, df)
+        await cache_set(model_key, model_to_json(model).encode(), settings.forecast_cache_ttl)
 
-    # Create future dataframe
-    future = model.make_future_dataframe(periods=horizon_days)
+    # Create future dataframe (future dates only, so no post-filtering needed)
+    future = model.make_future_dataframe(periods=horizon_days, include_history=False)
 
     # Generate predictions
-    forecast = model.predict(future)
+    forecast = await asyncio.to_thread(model.predict, future)
+    forecast = forecast[["ds", "yhat", "yhat_lower", "yhat_upper"]]
 
-    # Return only future predictions
-    forecast = forecast[forecast["ds"] > df["ds"].max()]
+    await cache_set(
+        forecast_key,
+        forecast.to_json(orient="split", date_format="iso", index=False).encode(),
+        settings.forecast_cache_ttl,
+    )
+
+    return forecast
+
+
+def store_scenario_forecasts(
+    session,
+    forecast_run_id: str,
+    company_id: str,
+    scenario_forecasts: dict[str, pd.DataFrame],
+):
+    """Store every scenario's forecasts and commit once"""
+    for scenario, forecasts in scenario_forecasts.items():
+        store_forecasts(session, forecast_run_id, company_id, forecasts, scenario)
 
-    return forecast[["ds", "yhat", "yhat_lower", "yhat_upper"]]
+    session.commit()
 
 
 def store_forecasts(
@@ -307,42 +515,75 @@ def store_forecasts(
     forecasts: pd.DataFrame,
     scenario: str,
 ):
-    """Store forecast results in database"""
-    for _, row in forecasts.iterrows():
-        # Calculate daily inflow/outflow from balance change
-        predicted_balance = int(row["yhat"] * 100)  # Convert to cents
-        confidence_lower = int(row["yhat_lower"] * 100)
-        confidence_upper = int(row["yhat_upper"] * 100)
-
-        session.execute(
-            text("""
-                INSERT INTO forecasts (
-                    id, company_id, forecast_run_id, forecast_date,
-                    predicted_balance, predicted_inflow, predicted_outflow,
-                    confidence_lower, confidence_upper, confidence_level,
-                    scenario, model_version, created_at
-                ) VALUES (
-                    gen_random_uuid(), :company_id, :run_id, :forecast_date,
-                    :balance, :inflow, :outflow,
-                    :lower, :upper, 0.80,
-                    :scenario, :version, NOW()
-                )
-            """),
-            {
-                "company_id": company_id,
-                "run_id": forecast_run_id,
-                "forecast_date": row["ds"],
-                "balance": predicted_balance,
-                "inflow": max(0, predicted_balance),  # Simplified
-                "outflow": abs(min(0, predicted_balance)),  # Simplified
-                "lower": confidence_lower,
-                "upper": confidence_upper,
-                "scenario": scenario,
-                "version": settings.model_version,
-            },
+    """Store forecast results for one scenario (committed by the caller)"""
+    # Convert dollars to cents on whole columns rather than per row
+    balance = np.rint(forecasts["yhat"].to_numpy() * 100).astype(np.int64)
+    inflow = np.maximum(0, balance)  # Simplified
+    outflow = np.abs(np.minimum(0, balance))  # Simplified
+    lower = np.rint(forecasts["yhat_lower"].to_numpy() * 100).astype(np.int64)
+    upper = np.rint(forecasts["yhat_upper"].to_numpy() * 100).astype(np.int64)
+
+    # tolist() yields native Python values the DB driver can adapt
+    records = [
+        {
+            "company_id": company_id,
+            "run_id": forecast_run_id,
+            "forecast_date": date,
+            "balance": b,
+            "inflow": i,
+            "outflow": o,
+            "lower": lo,
+            "upper": up,
+            "scenario": scenario,
+            "version": settings.model_version,
+        }
+        for date, b, i, o, lo, up in zip(
+            forecasts["ds"].tolist(),
+            balance.tolist(),
+            inflow.tolist(),
+            outflow.tolist(),
+            lower.tolist(),
+            upper.tolist(),
         )
+    ]
 
-    session.commit()
+    if not records:
+        return
+
+    # Single executemany batch instead of one round-trip per row
+    session.execute(
+        text("""
+            INSERT INTO forecasts (
+                id, company_id, forecast_run_id, forecast_date,
+                predicted_balance, predicted_inflow, predicted_outflow,
+                confidence_lower, confidence_upper, confidence_level,
+                scenario, model_version, created_at
+            ) VALUES (
+                gen_random_uuid(), :company_id, :run_id, :forecast_date,
+                :balance, :inflow, :outflow,
+                :lower, :upper, 0.80,
+                :scenario, :version, NOW()
+            )
+        """),
+        records,
+    )
+
+
+async def get_accuracy_metrics(
+    historical: pd.DataFrame,
+    forecast: pd.DataFrame,
+    company_id: str,
+) -> dict:
+    """Calculate accuracy metrics, reusing cached results for unchanged data"""
+    key = f"v2:prophet:{company_id}:accuracy:{prophet_data_hash(historical)}"
+
+    cached_metrics = await cache_get(key)
+    if cached_metrics is not None:
+        return json.loads(cached_metrics)
+
+    metrics = await asyncio.to_thread(calculate_accuracy, historical, forecast)
+    await cache_set(key, json.dumps(metrics, allow_nan=False).encode(), settings.forecast_cache_ttl)
+    return metrics
 
 
 def calculate_accuracy(
@@ -358,49 +599,39 @@ def calculate_accuracy(
     test = historical.iloc[-30:]
 
     # Fit model on training data
+    # Only point predictions are scored, so skip uncertainty sampling
     model = Prophet(
         yearly_seasonality=True,
         weekly_seasonality=True,
+        uncertainty_samples=0,
+        stan_backend="CMDSTANPY",
     )
     model.fit(train)
 
-    # Predict on test period
-    future = model.make_future_dataframe(periods=30)
-    predictions = model.predict(future)
-    predictions = predictions[predictions["ds"].isin(test["ds"])]
+    # Predict directly on the test dates so rows line up with y_true
+    predictions = model.predict(test[["ds"]])
 
     # Calculate metrics
-    if len(predictions) == 0:
-        return {"mape": None, "rmse": None, "mae": None}
-
     y_true = test["y"].values
-    y_pred = predictions["yhat"].values[:len(y_true)]
+    y_pred = predictions["yhat"].values
+
+    # Compute the residuals once and reuse them for every metric
+    diff = y_true - y_pred
+    abs_diff = np.abs(diff)
 
-    mape = np.mean(np.abs((y_true - y_pred) / y_true)) * 100
-    rmse = np.sqrt(np.mean((y_true - y_pred) ** 2))
-    mae = np.mean(np.abs(y_true - y_pred))
+    mape = np.mean(abs_diff / np.abs(y_true)) * 100
+    rmse = np.sqrt(np.dot(diff, diff) / diff.size)
+    mae = np.mean(abs_diff)
 
+    # A zero balance in y_true makes MAPE inf/nan, which jsonb rejects
     return {
-        "mape": round(mape, 2),
-        "rmse": round(rmse, 2),
-        "mae": round(mae, 2),
+        name: round(float(value), 2) if np.isfinite(value) else None
+        for name, value in (("mape", mape), ("rmse", rmse), ("mae", mae))
     }
 
 
-async def generate_forecast_alerts(session, company_id: str, forecast_run_id: str):
+def generate_forecast_alerts(session, company_id: str, forecast_run_id: str):
     """Generate alerts based on forecast results"""
-    # Get forecast data
-    result = session.execute(
-        text("""
-            SELECT forecast_date, predicted_balance, confidence_lower
-            FROM forecasts
-            WHERE forecast_run_id = :run_id AND scenario = 'baseline'
-            ORDER BY forecast_date
-        """),
-        {"run_id": forecast_run_id},
-    )
-    forecasts = result.fetchall()
-
     # Get current balance
     balance_result = session.execute(
         text("""
@@ -412,31 +643,35 @@ async def generate_forecast_alerts(session, company_id: str, forecast_run_id: st
     )
     current_balance = balance_result.scalar() or 0
 
-    # Check for cash shortage alerts
-    for date, predicted, lower in forecasts:
-        # Alert if predicted balance drops significantly
-        if predicted < current_balance * 0.2:  # 80% drop
-            session.execute(
-                text("""
-                    INSERT INTO alerts (
-                        id, company_id, alert_type, severity,
-                        title, message, predicted_date, predicted_amount,
-                        status, created_at
-                    ) VALUES (
-                        gen_random_uuid(), :company_id, 'cash_shortage', 'critical',
-                        'Low Cash Balance Predicted',
-                        'Forecast indicates cash balance may drop to critically low levels.',
-                        :date, :amount, 'active', NOW()
-                    )
-                    ON CONFLICT DO NOTHING
-                """),
-                {
-                    "company_id": company_id,
-                    "date": date,
-                    "amount": predicted,
-                },
+    # Alert if predicted balance drops significantly (80% drop). The first
+    # breaching forecast is found and inserted in SQL, so no forecast rows
+    # are transferred; LIMIT 1 creates at most one alert.
+    session.execute(
+        text("""
+            INSERT INTO alerts (
+                id, company_id, alert_type, severity,
+                title, message, predicted_date, predicted_amount,
+                status, created_at
             )
-            break  # Only create one alert
+            SELECT
+                gen_random_uuid(), :company_id, 'cash_shortage', 'critical',
+                'Low Cash Balance Predicted',
+                'Forecast indicates cash balance may drop to critically low levels.',
+                forecast_date, predicted_balance, 'active', NOW()
+            FROM forecasts
+            WHERE forecast_run_id = :run_id
+            AND scenario = 'baseline'
+            AND predicted_balance < :threshold
+            ORDER BY forecast_date
+            LIMIT 1
+            ON CONFLICT DO NOTHING
+        """),
+        {
+            "company_id": company_id,
+            "run_id": forecast_run_id,
+            "threshold": float(current_balance) * 0.2,
+        },
+    )
 
     session.commit()
 
@@ -445,9 +680,78 @@ async def generate_forecast_alerts(session, company_id: str, forecast_run_id: st
 @app.post("/anomalies", response_model=AnomalyResponse)
 async def detect_anomalies(request: AnomalyRequest):
     """Detect anomalous transactions using Isolation Forest"""
+    rows = await asyncio.to_thread(
+        fetch_anomaly_candidates, request.company_id, request.transaction_ids
+    )
+
+    if len(rows) < 100:
+        return AnomalyResponse(anomalies=[], total_analyzed=len(rows))
+
+    # Prepare features straight from the row columns; IsolationForest
+    # works in float32 internally, so build the matrix in that dtype
+    ids, amounts, dates, categories = zip(*rows)
+    amount_abs = np.abs(np.fromiter(amounts, dtype=np.int64, count=len(rows))) / 100
+    day_of_week = np.fromiter((d.weekday() for d in dates), dtype=np.int8, count=len(rows))
+
+    features = np.column_stack((amount_abs, day_of_week)).astype(np.float32)
+
+    model = await get_anomaly_model(request.company_id, features)
+    predictions = await asyncio.to_thread(model.predict, features)
+
+    # Get anomalies
+    anomaly_indices = np.where(predictions == -1)[0]
+    anomalies = []
+
+    if anomaly_indices.size == 0:
+        return AnomalyResponse(anomalies=anomalies, total_analyzed=len(rows))
+
+    # Score all anomalies in one vectorized pass over the ensemble
+    scores = await asyncio.to_thread(model.score_samples, features[anomaly_indices])
+
+    for idx, score in zip(anomaly_indices, scores):
+        anomalies.append({
+            "transactionId": ids[idx],
+            "amount": float(amounts[idx]) / 100,
+            "date": str(dates[idx]),
+            "category": categories[idx],
+            "score": float(score),
+        })
+
+    return AnomalyResponse(
+        anomalies=anomalies,
+        total_analyzed=len(rows),
+    )
+
+
+async def get_anomaly_model(company_id: str, features: np.ndarray) -> IsolationForest:
+    """Reuse a recently fitted model for the company, refitting on data drift"""
+    # Models stay in process: sklearn estimators only serialize via pickle,
+    # which is unsafe to load from a shared Redis. Entries expire
+    # anomaly_model_ttl seconds after the fit that inserted them.
+    cached = anomaly_models.get(company_id)
+
+    # Reuse while the row count stays within 10% of the training set
+    if cached is not None:
+        fitted_rows, model = cached
+        if abs(len(features) - fitted_rows) <= 0.1 * fitted_rows:
+            return model
+
+    # Fit Isolation Forest
+    model = IsolationForest(
+        contamination=0.05,  # Expect 5% anomalies
+        random_state=42,
+    )
+    await asyncio.to_thread(model.fit, features)
+
+    anomaly_models[company_id] = (len(features), model)
+    return model
+
+
+def fetch_anomaly_candidates(company_id: str, transaction_ids: list[str]) -> list:
+    """Fetch transactions to screen for anomalies"""
     with SessionLocal() as session:
         # Fetch transactions
-        if request.transaction_ids:
+        if transaction_ids:
             result = session.execute(
                 text("""
                     SELECT id, amount, transaction_date, category_primary
@@ -456,8 +760,8 @@ async def detect_anomalies(request: AnomalyRequest):
                     AND id = ANY(:ids)
                 """),
                 {
-                    "company_id": request.company_id,
-                    "ids": request.transaction_ids,
+                    "company_id": company_id,
+                    "ids": transaction_ids,
                 },
             )
         else:
@@ -469,46 +773,10 @@ async def detect_anomalies(request: AnomalyRequest):
                     ORDER BY transaction_date DESC
                     LIMIT 1000
                 """),
-                {"company_id": request.company_id},
+                {"company_id": company_id},
             )
 
-        rows = result.fetchall()
-
-        if len(rows) < 100:
-            return AnomalyResponse(anomalies=[], total_analyzed=len(rows))
-
-        # Prepare features
-        df = pd.DataFrame(rows, columns=["id", "amount", "date", "category"])
-        df["amount_abs"] = df["amount"].abs() / 100
-        df["day_of_week"] = pd.to_datetime(df["date"]).dt.dayofweek
-
-        features = df[["amount_abs", "day_of_week"]].values
-
-        # Fit Isolation Forest
-        model = IsolationForest(
-            contamination=0.05,  # Expect 5% anomalies
-            random_state=42,
-        )
-        predictions = model.fit_predict(features)
-
-        # Get anomalies
-        anomaly_indices = np.where(predictions == -1)[0]
-        anomalies = []
-
-        for idx in anomaly_indices:
-            row = df.iloc[idx]
-            anomalies.append({
-                "transactionId": row["id"],
-                "amount": float(row["amount"]) / 100,
-                "date": str(row["date"]),
-                "category": row["category"],
-                "score": float(model.score_samples(features[idx:idx+1])[0]),
-            })
-
-        return AnomalyResponse(
-            anomalies=anomalies,
-            total_analyzed=len(rows),
-        )
+        return result.fetchall()
 
 
 if __name__ == "__main__":
@@ -9,6 +9,9 @@ CREATE EXTENSION IF NOT EXISTS pgcrypto;
 -- Convert transactions to hypertable (after Prisma creates the table)
 -- SELECT create_hypertable('transactions', by_range('transaction_date', INTERVAL '1 month'), if_not_exists => TRUE);
 
+-- Covering index for the ML service's daily totals query (index-only scan)
+-- CREATE INDEX IF NOT EXISTS transactions_company_date_amount_idx ON transactions (company_id, transaction_date) INCLUDE (amount);
+
 -- Convert forecasts to hypertable
 -- SELECT create_hypertable('forecasts', by_range('forecast_date', INTERVAL '3 months'), if_not_exists => TRUE);
 